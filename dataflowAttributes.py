@@ -1,9 +1,346 @@
+import ast
+import contextlib
+import copy
+import hashlib
+import inspect
+import marshal
+import os
+import sys
+import textwrap
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+# Directory in which DataflowBase caches, across processes, what it works out about each class
+# (topological order, masks, compiled recalculation function). None disables the cache. It can
+# be set here before classes are defined, or through the DATAFLOW_CACHE_DIR environment variable.
+DATAFLOW_CACHE_DIR = os.environ.get('DATAFLOW_CACHE_DIR') or None
+
 class AttrNullState(object):
     """
-    This is just a special "attribute value is invalid" placeholder.
+    This is just a special "attribute has no value yet" placeholder, the initial value of
+    attributes that must be calculated before first use.
     """
     pass
 
+def _same_value(current, value):
+    """
+    Whether assigning value over current changes nothing: they are identical, or equal and of
+    the same type. Values that cannot be compared to a truth value (e.g. arrays) count as changed.
+    """
+    if current is value:
+        return True
+    if current is AttrNullState or type(current) is not type(value):
+        return False
+    try:
+        return bool(current == value)
+    except Exception:
+        return False
+
+def _inline_body(attr, source, topo_attrs):
+    """
+    Rewrites the source of the update function of attr into lines of code for the
+    recalculation function, or returns None if it cannot be inlined.
+
+    The function must take only self, and must not return, yield, use nested scopes,
+    global/nonlocal/import statements or private (mangled) names. Its local variables are
+    renamed to avoid clashes, self becomes obj, reading one of the attribute's dependencies
+    reads the instance's value list directly, and assigning the attribute does what __set__
+    would.
+    """
+    if not hasattr(ast, 'unparse'):  # Python < 3.9
+        return None
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+    if len(tree.body) != 1 or not isinstance(tree.body[0], ast.FunctionDef):
+        return None
+    func = tree.body[0]
+    args = func.args
+    if (len(args.args) != 1 or args.posonlyargs or args.vararg or args.kwonlyargs
+            or args.kwarg):
+        return None
+    me = args.args[0].arg
+    k = attr._idx
+    parents = {topo_attrs[idx].name: idx for idx in attr._dep_idxs}
+
+    def is_own(target):
+        return (isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name)
+                and target.value.id == me and target.attr == attr.name)
+
+    # Check the body can be inlined, and find its local variables.
+    forbidden = (ast.Return, ast.Yield, ast.YieldFrom, ast.Await, ast.Global, ast.Nonlocal,
+                 ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda, ast.Import,
+                 ast.ImportFrom) + ((ast.Match,) if hasattr(ast, 'Match') else ())
+    local_names = set()
+    loaded_names = set()
+    for stmt in func.body:
+        for node in ast.walk(stmt):
+            if isinstance(node, forbidden):
+                return None
+            # Private names were mangled with the name of the class the function is defined in,
+            # which the inlined code is not.
+            for field in ('id', 'attr', 'arg', 'name'):
+                name = getattr(node, field, None)
+                if isinstance(name, str) and name.startswith('__') and not name.endswith('__'):
+                    return None
+            if isinstance(node, ast.Name):
+                if not isinstance(node.ctx, ast.Load):
+                    if node.id == me:
+                        return None
+                    local_names.add(node.id)
+                else:
+                    loaded_names.add(node.id)
+            elif isinstance(node, ast.ExceptHandler) and node.name:
+                local_names.add(node.name)
+            elif isinstance(node, (ast.AugAssign, ast.AnnAssign)) and is_own(node.target):
+                return None
+            elif isinstance(node, ast.Delete) and any(is_own(t) for t in node.targets):
+                return None
+            elif isinstance(node, ast.Assign) and (len(node.targets) != 1 and any(
+                    is_own(t) for t in node.targets)):
+                return None
+            elif isinstance(node, (ast.Tuple, ast.List)) and any(is_own(e) for e in node.elts):
+                return None
+    # Globals the body reads must not be shadowed by the recalculation function's own names.
+    reserved = {'obj', 'needed', 'versions', 'sigs', 'sig', 'values', '_same'}
+    for name in loaded_names - local_names - {me}:
+        if name in reserved or name.startswith('_calc_'):
+            return None
+
+    def local(name):
+        return '_%d_%s' % (k, name)
+
+    set_source = ['_new_%d = None' % k,
+                  '_old_%d = values[%d]' % (k, k),
+                  'values[%d] = _new_%d' % (k, k),
+                  'obj.__dirty__ &= ~%d' % attr._bit,
+                  'if not _same(_old_%d, _new_%d):' % (k, k),
+                  '    versions[%d] += 1' % k]
+    if attr._descendants_mask:
+        set_source.append('    obj.__dirty__ |= %d' % attr._descendants_mask)
+
+    class Inliner(ast.NodeTransformer):
+        def visit_Name(self, node):
+            if node.id == me:
+                return ast.copy_location(ast.Name('obj', node.ctx), node)
+            if node.id in local_names:
+                node.id = local(node.id)
+            return node
+
+        def visit_ExceptHandler(self, node):
+            if node.name:
+                node.name = local(node.name)
+            self.generic_visit(node)
+            return node
+
+        def visit_Attribute(self, node):
+            if (isinstance(node.ctx, ast.Load) and isinstance(node.value, ast.Name)
+                    and node.value.id == me and node.attr in parents):
+                return ast.copy_location(
+                    ast.Subscript(ast.Name('values', ast.Load()), ast.Constant(parents[node.attr]),
+                                  ast.Load()), node)
+            self.generic_visit(node)
+            return node
+
+        def visit_Assign(self, node):
+            if not is_own(node.targets[0]):
+                self.generic_visit(node)
+                return node
+            stmts = ast.parse('\n'.join(set_source)).body
+            stmts[0].value = self.visit(node.value)
+            return stmts
+
+    body = func.body
+    if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant):
+        body = body[1:]
+    if not body:
+        return None
+    inlined = []
+    for stmt in body:
+        # Assignments of the attribute become several statements.
+        stmt = Inliner().visit(stmt)
+        inlined.extend(stmt if isinstance(stmt, list) else [stmt])
+    module = ast.fix_missing_locations(ast.Module(body=inlined, type_ignores=[]))
+    return ast.unparse(module).splitlines()
+
+def _generate_recompute(topo_attrs, inline_sources=None, locked=False):
+    """
+    Generates the source of the recalculation function of a DataflowBase subclass, whose
+    attributes are given in topological order. It must be executed in a namespace holding
+    _same_value, and the update function of attribute k as _calc_k.
+
+    The update functions whose source is in inline_sources, keyed by attribute name, are
+    inlined where possible instead of being called. With locked, the function reads and clears
+    bits of __dirty__ itself under the class's __dataflow_lock__, as needed by parallel classes.
+
+    The function takes an instance and a mask of the attributes needed. Each needed attribute
+    that is invalid is marked valid again if its parents' versions are unchanged since its last
+    calculation, or else recalculated by calling its update function, which __set__'s the new
+    value and clears its bit of __dirty__. Update functions that do not set their attribute are
+    reported, unless python runs with -O.
+    """
+    # Update functions are bound as default arguments, so the function can be given the
+    # globals of inlined update functions.
+    params = ''.join(', _calc_%d=_calc_%d' % (attr._idx, attr._idx) for attr in topo_attrs
+                     if attr._calc_unbound is not None)
+    lines = ['def _dataflow_recompute(obj, needed, _same=_same_value%s):' % params,
+             '    values = obj.__dataflow_values__',
+             '    versions = obj.__dataflow_versions__',
+             '    sigs = obj.__dataflow_sigs__']
+    for attr in topo_attrs:
+        # Only attributes with dependencies, or without an initial value, are ever invalid.
+        if not attr._parents and attr._default is not AttrNullState:
+            continue
+        k = attr._idx
+        not_updated = ('Attribute %s calling %s did not result in an updated value.'
+                       % (attr.name, attr.calc_func))
+        # The live mask is tested, since an update function may set several attributes.
+        lines.append('    if needed & %d and obj.__dirty__ & %d:' % (attr._bit, attr._bit))
+        body = []
+        if attr.calc_func is None:
+            body.append('raise ValueError(%r)' % not_updated)
+        elif attr._calc_unbound is None:
+            body.append('raise ValueError(%r %% obj)' % ('Attribute %s cannot find method %s in '
+                                                         'object %%s' % (attr.name, attr.calc_func)))
+        else:
+            call = []
+            if attr.verbose:
+                call.append('print(%r)' % ('\tAttribute %s calling %s' % (attr.name, attr.calc_func)))
+            inlined = None
+            if inline_sources and attr.name in inline_sources:
+                inlined = _inline_body(attr, inline_sources[attr.name], topo_attrs)
+            if inlined is not None:
+                call.extend(inlined)
+            else:
+                call.append('_calc_%d(obj)' % k)
+            # Checking that the update function did set the value is left out under python -O.
+            if __debug__ and locked:
+                call.append('with type(obj).__dataflow_lock__:')
+                call.append('    if obj.__dirty__ & %d:' % attr._bit)
+                call.append('        raise ValueError(%r)' % not_updated)
+            elif __debug__:
+                call.append('if obj.__dirty__ & %d:' % attr._bit)
+                call.append('    raise ValueError(%r)' % not_updated)
+            body.append('sig = (%s)' % ''.join('versions[%d], ' % idx for idx in attr._dep_idxs))
+            body.append('if sigs[%d] == sig:' % k)
+            if locked:
+                body.append('    with type(obj).__dataflow_lock__:')
+                body.append('        obj.__dirty__ &= ~%d' % attr._bit)
+            else:
+                body.append('    obj.__dirty__ &= ~%d' % attr._bit)
+            body.append('else:')
+            body.extend('    ' + line for line in call)
+            body.append('    sigs[%d] = sig' % k)
+        lines.extend('        ' + line for line in body)
+    lines.append('')
+    return '\n'.join(lines)
+
+_module_digest = None
+
+def _get_module_digest():
+    # Plans hold code generated by this module, so a changed module must not reuse them. If
+    # its source cannot be read, the empty digest disables the cache.
+    global _module_digest
+    if _module_digest is None:
+        try:
+            with open(__file__, 'rb') as f:
+                _module_digest = hashlib.sha1(f.read()).hexdigest()
+        except (NameError, OSError):
+            _module_digest = ''
+    return _module_digest
+
+def _load_plan(path):
+    # A missing, unreadable or corrupt cache file just means a cache miss.
+    try:
+        with open(path, 'rb') as f:
+            return marshal.load(f)
+    except Exception:
+        return None
+
+def _store_plan(path, plan):
+    # Write to a temporary file first so that concurrent processes never read a partial file.
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            marshal.dump(plan, f)
+        os.replace(temp, path)
+    except OSError:
+        pass
+
+class _VerboseAttr(object):
+    """
+    Mixed into the class of DependentAttr instances created with verbose=True, so that the
+    printing lives here and the plain descriptor methods do no verbose checks at all.
+    """
+
+    __slots__ = ()
+
+    def __get__(self, obj, objtype):
+        if obj is None:
+            return self
+        print('%s GET: \t obj: %s \t objtype: %s' % (self.name, obj, objtype))
+        return super(_VerboseAttr, self).__get__(obj, objtype)
+
+    def __set__(self, obj, value):
+        print('%s SET: \t obj: %s \t value: %s' % (self.name, obj, value))
+        super(_VerboseAttr, self).__set__(obj, value)
+
+class _ParallelAttr(object):
+    """
+    Mixed into the class of the attributes of DataflowBase subclasses created with
+    parallel=True. Update functions of such classes may run concurrently, so assignments,
+    which read and write the instance's __dirty__ mask, are serialized by a per-class lock.
+    """
+
+    __slots__ = ()
+
+    def __set__(self, obj, value):
+        with type(obj).__dataflow_lock__:
+            super(_ParallelAttr, self).__set__(obj, value)
+
+# Marks the threads of the pools running update functions in parallel.
+_worker_state = threading.local()
+
+def _run_in_worker(recompute, obj, needed):
+    _worker_state.active = True
+    recompute(obj, needed)
+
+def _make_parallel_recompute(executor, levels, recompute):
+    """
+    Makes the recalculation function of a DataflowBase subclass created with parallel=True.
+
+    Attributes are grouped in levels, the length of the longest dependency chain above them,
+    so attributes of a level never depend on one another. The needed invalid attributes of each
+    level are recalculated together on the class's thread pool by the sequential recompute
+    function, one task per update function (so that a function updating several attributes
+    never runs twice at once), and the level is waited on before the next one starts.
+    Recalculations triggered from within a pool thread run sequentially, so the pool cannot
+    deadlock.
+    """
+    def _dataflow_recompute_parallel(obj, needed):
+        if getattr(_worker_state, 'active', False):
+            return recompute(obj, needed)
+        for level in levels:
+            # Earlier levels may have set attributes of this one.
+            dirty = obj.__dirty__ & needed
+            tasks = {}
+            for attr in level:
+                if dirty & attr._bit:
+                    tasks[attr._calc_unbound] = tasks.get(attr._calc_unbound, 0) | attr._bit
+            if len(tasks) == 1:
+                recompute(obj, *tasks.values())
+            elif tasks:
+                futures = [executor.submit(_run_in_worker, recompute, obj, mask)
+                           for mask in tasks.values()]
+                for future in futures:
+                    future.exception()
+                for future in futures:
+                    future.result()
+    return _dataflow_recompute_parallel
+
 class DependentAttr(object):
     """
     This descriptor class takes care of directed, acyclic dependencies among the attributes
@@ -11,7 +348,7 @@ class DependentAttr(object):
     free of cycles.
     
     When used in a class definition like...
-        class DataflowSuccess():
+        class DataflowSuccess(DataflowBase):
     
         # The following defines the directed acyclic computation graph for these attributes.
         a1 = DependentAttr(1, [], None, 'a1')
@@ -31,18 +368,40 @@ class DependentAttr(object):
     
     Thus, a user is free to change the parameters of those attributes without dependencies 
     (a1 and a6 in the above example are independent) without causing nor requiring potentially-
-    costly value updates. Instead, changing an attribute to a new value causes a cascade, setting 
-    its childrens' values (dependent attributes) to a special null value: AttrNullState.
+    costly value updates. Instead, changing an attribute to a new value causes a cascade, marking
+    its descendants (dependent attributes, and theirs, and so forth) as invalid. Each instance
+    holds these marks as bits of an integer, __dirty__, so any value, including None and
+    AttrNullState, is a legitimate attribute value.
+
+    Values are stored per instance, in a list indexed by the attribute's position in the class's
+    topological order; the descriptor itself only holds the initial value shared by all instances.
+
+    Each change of a value bumps a per-instance version of that attribute. An invalidated
+    attribute whose dependencies' versions are unchanged since its last calculation (because a
+    recalculated dependency came out equal to its previous value) keeps its value without
+    calling its update function.
 
     Importantly, updating dependent attributes does not occur until a value is requested (via calling 
     getattr, obj.attr, etc). If an attribute has been made invalid by the previous changing of a 
-    dependency, it will recursively trigger the required updates when its __get__ method is called.
+    dependency, it will trigger the required updates, of itself and of its invalid ancestors in
+    topological order, when its __get__ method is called.
+
+    The owning class must subclass DataflowBase, which resolves the dependency graph once when
+    the class is created rather than on every attribute access.
     """
 
+    __slots__ = ('_default', 'dependencies', 'calc_func', 'name', 'verbose', '_parents',
+                 '_children', '_dep_idxs', '_calc_unbound', '_idx', '_bit', '_descendants_mask',
+                 '_ancestors_mask', '_recompute')
+
+    # Variants of DependentAttr and its subclasses with a mixin, created as needed.
+    _variant_classes = {}
+
     def __init__(self, init_value, dependencies: list, calc_func: str, name, verbose=False):
         """
-        init_value: initial internal value to be yielded by __get__.
-        dependencies: a list of attributes which this attribute requires to be calculated.
+        init_value: initial value yielded by __get__ for every new instance.
+        dependencies: a list (or other iterable) of the names of the other attributes of the
+            class which this attribute requires to be calculated. It is kept as a tuple.
         calc_func: the class function which __set__'s the value of this variable.
         name: The name of this attribute.
         verbose: Prints things for helpful debugging / understanding.
@@ -53,68 +412,413 @@ class DependentAttr(object):
         if init_value is None and len(dependencies)>0:
             init_value = AttrNullState
         # Set descriptor attributs.
-        self.value = init_value
-        self.dependencies = dependencies
+        self._default = init_value
+        self.dependencies = tuple(dependencies)
         self.calc_func = calc_func
         self.name = name
-        # Children will be added as necessary during runtime.
-        self.children = []
+        # Children and parents are resolved by DataflowBase when the owning class is created.
+        self._parents = ()
+        self._children = ()
+        self._dep_idxs = ()
+        self._calc_unbound = None
+        self._idx = None
+        self._bit = 0
+        self._descendants_mask = 0
+        self._ancestors_mask = 0
+        self._recompute = None
         self.verbose = verbose
         if self.verbose:
-           print('%s INIT: \t init_value: %s \t dependencies: %s \t calc_func: %s' %
-                 (self.name, self.value, self.dependencies, self.calc_func))
+            # Switch to a variant of this class whose __get__ and __set__ print.
+            self._mix_in(_VerboseAttr, 'Verbose')
+            print('%s INIT: \t init_value: %s \t dependencies: %s \t calc_func: %s' %
+                  (self.name, self._default, self.dependencies, self.calc_func))
+
+    def _mix_in(self, mixin, prefix):
+        # Switch this descriptor to a variant of its class with mixin in front of it.
+        cls = type(self)
+        if (mixin, cls) not in DependentAttr._variant_classes:
+            DependentAttr._variant_classes[mixin, cls] = type(prefix + cls.__name__,
+                                                              (mixin, cls), {'__slots__': ()})
+        self.__class__ = DependentAttr._variant_classes[mixin, cls]
+
+    def _mix_out(self, mixin):
+        # Undo _mix_in(mixin, ...), which must have been the last one applied.
+        if isinstance(self, mixin):
+            self.__class__ = type(self).__bases__[1]
+
+    def __set_name__(self, owner, name):
+        # Register this attribute with its owning class. The dependency graph is resolved
+        # afterwards, once all of the class's attributes are bound, by DataflowBase.
+        if not issubclass(owner, DataflowBase):
+            raise TypeError('Class %s defining attribute %s must subclass DataflowBase'
+                            % (owner.__name__, name))
+        if self.name != name:
+            raise ValueError('Attribute %s is bound to class attribute %s of %s'
+                             % (self.name, name, owner.__name__))
+        if '__dataflow_attrs__' not in owner.__dict__:
+            owner.__dataflow_attrs__ = {}
+        owner.__dataflow_attrs__[name] = self
 
     def __get__(self, obj, objtype):
         # This defines the behavior when using type(parent_object).attr
         if obj is None:
             return self
-        if self.verbose:
-            print('%s GET: \t obj: %s \t objtype: %s' % (self.name, obj, objtype))
-        # None indicates the value must be recalculated.
-        if self.value is AttrNullState:
-            # Trigger the calculation of any attributes this one depends upon.
-            for dependency in self.dependencies:
-                if not hasattr(obj, dependency):
-                    raise ValueError('Attribute %s is a dependency of %s but is not an attribute of %s'
-                                     % (dependency, self.name, obj))
-                # Get the dependency's descriptor via the defined type(obj).attr
-                parent = getattr(type(obj), dependency, None)
-                # If this descriptor doesn't know this is a child, inform it.
-                if parent is not None:
-                    if isinstance(parent, DependentAttr):
-                        if self.name not in parent.children:
-                            parent.children.append(self.name)
-                # Get the dependency's value in order to trigger it to update.
-                attr_value = getattr(obj, dependency)
-                # Throw an error if the update was not successful and it should have been.
-                if attr_value is AttrNullState:
-                    if isinstance(getattr(type(obj), dependency, None), DependentAttr):
-                        raise ValueError('Attribute %s requires %s but value was None' 
-                                         % (self.name, dependency))
-            # Execute function that re-calculates the value now all dependencies are ready.
-            if self.calc_func is not None:
-                update_func = getattr(obj, self.calc_func, None)
-                if update_func is not None: 
-                    if self.verbose: print('\tAttribute %s calling %s' 
-                                           % (self.name,self.calc_func))
-                    update_func()
-                else: raise ValueError('Attribute %s cannot find method %s in object %s' 
-                                       % (self.name, self.calc_func, obj))
-        # By now, __set__ should have been called and has set the value.
-        if self.value is AttrNullState: 
-            raise ValueError('Attribute %s calling %s did not result in an updated value.' 
-                                                         % (self.name, self.calc_func))
-        return self.value
+        # An invalid value must be recalculated, along with any invalid attributes it depends
+        # upon, by the class's generated recalculation function.
+        if obj.__dirty__ & self._bit:
+            pending = obj.__pending_sets__
+            if pending is None:
+                self._recompute(obj, self._ancestors_mask)
+            else:
+                # Within batch_update, the assignments made by update functions take effect
+                # at once; only the others are deferred.
+                obj.__pending_sets__ = None
+                try:
+                    self._recompute(obj, self._ancestors_mask)
+                finally:
+                    obj.__pending_sets__ = pending
+        return obj.__dataflow_values__[self._idx]
 
     def __set__(self, obj, value):
-        if self.verbose:
-            print('%s SET: \t obj: %s \t value: %s' % (self.name, obj, value))
-        if self.value is not value:
-            self.value = value
-            # Set all attributes that depend upon this attribute to null state.
-            for child in self.children:
-                # In turn, these attributes will set their children to null state, and so forth.
-                setattr(obj, child, AttrNullState)
+        if obj.__pending_sets__ is not None:
+            # Within batch_update; applied when the batch ends.
+            obj.__pending_sets__.append((self, value))
+            return
+        values = obj.__dataflow_values__
+        idx = self._idx
+        current = values[idx]
+        dirty = obj.__dirty__
+        if dirty & self._bit:
+            # Being recalculated. The invalid value is the one descendants were calculated
+            # from, so they stay valid if the new value equals it.
+            values[idx] = value
+            dirty &= ~self._bit
+            obj.__dirty__ = dirty
+            if _same_value(current, value):
+                return
+        elif _same_value(current, value):
+            # Re-assigning the current value, or an equal one, changes nothing.
+            return
+        else:
+            values[idx] = value
+            if self._parents:
+                # Assigned from outside, so the value was not calculated from the parents'
+                # current versions and must not be kept by memoization when they change.
+                obj.__dataflow_sigs__[idx] = None
+        # Record the change for the memoization of descendants.
+        obj.__dataflow_versions__[idx] += 1
+        # Mark all attributes that directly or indirectly depend upon this attribute as invalid.
+        obj.__dirty__ = dirty | self._descendants_mask
+
+class DataflowBase(object):
+    """
+    Base class for classes whose attributes are DependentAttr descriptors.
+
+    Each DependentAttr registers itself with its owning class through __set_name__. Once the
+    class has been created, __init_subclass__ resolves every dependency name to its descriptor
+    (_parents), gives each parent the descriptors of its children (_children), looks up each
+    update method, and numbers the attributes in a topological order cached as
+    __dataflow_topo__ (names) and __descriptors__. Dependencies are then referred to by number
+    (_dep_idxs), and each attribute's transitive dependents are stored as a bitmask over those
+    numbers, in the attribute's _descendants_mask and in the class's __descendants_mask__. This
+    happens once per class, so getting an attribute never has to discover the dependency graph.
+    The resolved graph is immutable (tuples and a read-only __dataflow_attrs__ mapping), so
+    threads share it without locking.
+
+    Finally, a recalculation function specialized to the class is generated (its source is kept
+    as __dataflow_source__). Given a mask of the attributes needed, it brings every invalid one
+    up to date in topological order as straight-line code, with no graph walks at run time.
+
+    When DATAFLOW_CACHE_DIR is set, the topological order, masks and compiled recalculation
+    function are cached there, keyed by the shape of the class's graph and the source of this
+    module, so processes that define the same class again skip working them out.
+
+    A class created with the keyword parallel=True, as in
+        class Pipeline(DataflowBase, parallel=True):
+    instead recalculates attributes that do not depend on one another concurrently, on a thread
+    pool of the class. This helps when update functions wait on I/O or call code that releases
+    the GIL. Subclasses inherit the setting.
+
+    Attributes inherited from base classes are included. They are copied into the subclass,
+    since their place in the graph may differ from the one they have in the base class.
+
+    Each instance keeps its attribute values, and the versions and dependency versions used for
+    memoization, in lists indexed by attribute number, and the bitmask of its invalid attributes
+    as __dirty__. These are allocated in __new__ and held in slots, along with the assignments
+    deferred by batch_update.
+    A subclass that declares __slots__ = () (along with all of its other bases) has no instance
+    __dict__ at all.
+    """
+
+    __slots__ = ('__dataflow_values__', '__dataflow_versions__', '__dataflow_sigs__',
+                 '__dirty__', '__pending_sets__')
+
+    __dataflow_attrs__ = types.MappingProxyType({})
+    __dataflow_topo__ = ()
+    __descriptors__ = ()
+    __dataflow_defaults__ = ()
+    __dataflow_dirty__ = 0
+    __dataflow_parallel__ = False
+    __dataflow_lock__ = None
+    __dataflow_executor__ = None
+    __descendants_mask__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        obj = super().__new__(cls)
+        n = len(cls.__dataflow_defaults__)
+        obj.__dataflow_values__ = list(cls.__dataflow_defaults__)
+        obj.__dataflow_versions__ = [0] * n
+        obj.__dataflow_sigs__ = [None] * n
+        obj.__dirty__ = cls.__dataflow_dirty__
+        obj.__pending_sets__ = None
+        return obj
+
+    def __reduce_ex__(self, protocol):
+        # The default reduction, used by copy and pickle, would give copies the same lists, so
+        # assigning an attribute of one would change the other's value but not its __dirty__.
+        reduced = super().__reduce_ex__(protocol)
+        state = reduced[2]
+        if isinstance(state, tuple) and state[1]:
+            slots = dict(state[1])
+            for name in ('__dataflow_values__', '__dataflow_versions__', '__dataflow_sigs__'):
+                slots[name] = list(slots[name])
+            slots['__pending_sets__'] = None
+            reduced = reduced[:2] + ((state[0], slots),) + reduced[3:]
+        return reduced
+
+    @contextlib.contextmanager
+    def batch_update(self):
+        """
+        Defers the assignments of attributes made within the context to its end, as in
+            with obj.batch_update():
+                obj.a1 = 9
+                obj.a6 = 4
+        so that the attributes depending on them are invalidated once rather than after each
+        assignment. Until then, getting an assigned attribute gives its value from before the
+        batch. The assignments made by update functions, when an invalid attribute is gotten
+        within the batch, still take effect at once. Nested batches are part of the outermost
+        one.
+        """
+        if self.__pending_sets__ is not None:
+            yield self
+            return
+        self.__pending_sets__ = pending = []
+        try:
+            yield self
+        finally:
+            self.__pending_sets__ = None
+            lock = type(self).__dataflow_lock__
+            with lock if lock is not None else contextlib.nullcontext():
+                self._apply_pending_sets(pending)
+
+    def _apply_pending_sets(self, pending):
+        # Same as assigning the values in order with __set__, but the __dirty__ mask is only
+        # written once.
+        values = self.__dataflow_values__
+        versions = self.__dataflow_versions__
+        dirty = self.__dirty__
+        for attr, value in pending:
+            idx = attr._idx
+            current = values[idx]
+            if dirty & attr._bit:
+                values[idx] = value
+                dirty &= ~attr._bit
+                if _same_value(current, value):
+                    continue
+            elif _same_value(current, value):
+                continue
+            else:
+                values[idx] = value
+                if attr._parents:
+                    self.__dataflow_sigs__[idx] = None
+            versions[idx] += 1
+            dirty |= attr._descendants_mask
+        self.__dirty__ = dirty
+
+    def __init_subclass__(cls, parallel=None, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if parallel is not None:
+            cls.__dataflow_parallel__ = parallel
+        # Gather the attributes of this class and its bases; subclasses override bases.
+        attrs = {}
+        for klass in reversed(cls.__mro__):
+            attrs.update(klass.__dict__.get('__dataflow_attrs__', {}))
+        own = cls.__dict__.get('__dataflow_attrs__', {})
+        for name in list(attrs):
+            if name in own:
+                continue
+            # Inherited: the attribute the class actually gets is the first one in its MRO.
+            # One overridden by something other than a DependentAttr leaves the graph.
+            inherited = next(klass.__dict__[name] for klass in cls.__mro__
+                             if name in klass.__dict__)
+            if not isinstance(inherited, DependentAttr):
+                del attrs[name]
+                continue
+            attr = copy.copy(inherited)
+            if name not in cls.__dict__:
+                setattr(cls, name, attr)
+            attrs[name] = attr
+        # Resolve dependency names to descriptors and record the reverse edges. A dependency
+        # that is not an attribute of the class is a mistake in its definition.
+        children = {name: [] for name in attrs}
+        for attr in attrs.values():
+            # A dependency listed twice is one edge.
+            dependencies = tuple(dict.fromkeys(attr.dependencies))
+            for dependency in dependencies:
+                if dependency not in attrs:
+                    raise KeyError('Attribute %s is a dependency of %s but is not a DependentAttr '
+                                   'of %s' % (dependency, attr.name, cls.__name__))
+                children[dependency].append(attr)
+            attr._parents = tuple(attrs[dependency] for dependency in dependencies)
+            # Look the update method up once; it is called with the instance directly.
+            if attr.calc_func is not None:
+                attr._calc_unbound = getattr(cls, attr.calc_func, None)
+        # Once resolved, the graph is only read, so it is held in immutable containers that
+        # threads can share without locking.
+        for name, attr in attrs.items():
+            attr._children = tuple(children[name])
+        # Find the update functions marked by inline_into_dag. Inlined code runs with the
+        # globals of the functions it comes from, so all of them must share their globals.
+        inline_sources = {}
+        inline_globals = None
+        for name, attr in attrs.items():
+            func = attr._calc_unbound
+            if (cls.__dataflow_parallel__ or attr.verbose
+                    or not getattr(func, '__dataflow_inline__', False)
+                    or not isinstance(func, types.FunctionType) or func.__code__.co_freevars
+                    or inline_globals not in (None, func.__globals__)):
+                continue
+            try:
+                inline_sources[name] = textwrap.dedent(inspect.getsource(func))
+            except (OSError, TypeError):
+                continue
+            inline_globals = func.__globals__
+        # The rest depends only on the shape of the graph, so it may have been cached by an
+        # earlier process defining the same class.
+        plan = cache_path = None
+        if DATAFLOW_CACHE_DIR is not None and _get_module_digest():
+            shape = [(name, attr.dependencies, attr.calc_func, attr._calc_unbound is None,
+                      attr._default is AttrNullState, attr.verbose, inline_sources.get(name))
+                     for name, attr in attrs.items()]
+            key = repr((_get_module_digest(), sys.implementation.cache_tag, sys.flags.optimize,
+                        cls.__module__, cls.__qualname__, bool(cls.__dataflow_parallel__), shape))
+            cache_path = os.path.join(DATAFLOW_CACHE_DIR,
+                                      hashlib.sha1(key.encode()).hexdigest() + '.marshal')
+            plan = _load_plan(cache_path)
+        if plan is not None:
+            topo = plan['topo']
+        else:
+            # Topologically sort the attributes (Kahn's algorithm), which also detects cycles.
+            in_degree = {name: len(attr._parents) for name, attr in attrs.items()}
+            ready = [name for name, degree in in_degree.items() if degree == 0]
+            topo = []
+            while ready:
+                name = ready.pop(0)
+                topo.append(name)
+                for child in attrs[name]._children:
+                    in_degree[child.name] -= 1
+                    if in_degree[child.name] == 0:
+                        ready.append(child.name)
+            if len(topo) != len(attrs):
+                raise ValueError('Attributes %s of %s form a dependency cycle'
+                                 % (sorted(set(attrs) - set(topo)), cls.__name__))
+        # From here on attributes are referred to by their number in topological order.
+        descriptors = tuple(attrs[name] for name in topo)
+        for idx, attr in enumerate(descriptors):
+            attr._idx = idx
+            attr._bit = 1 << idx
+            attr._dep_idxs = tuple(parent._idx for parent in attr._parents)
+        if plan is not None:
+            for attr, descendants, ancestors in zip(descriptors, plan['descendants'],
+                                                    plan['ancestors']):
+                attr._descendants_mask = descendants
+                attr._ancestors_mask = ancestors
+            source = plan['source']
+            code = plan['code']
+        else:
+            # Collect every attribute downstream of each attribute as a bitmask, so that
+            # invalidation is a single loop rather than a recursive cascade. Children come
+            # later in topological order, so each attribute is complete before its parents.
+            for attr in descriptors:
+                attr._descendants_mask = 0
+            for attr in reversed(descriptors):
+                for idx in attr._dep_idxs:
+                    descriptors[idx]._descendants_mask |= attr._bit | attr._descendants_mask
+            for attr in descriptors:
+                mask = attr._bit
+                for idx in attr._dep_idxs:
+                    mask |= descriptors[idx]._ancestors_mask
+                attr._ancestors_mask = mask
+            source = _generate_recompute(descriptors, inline_sources,
+                                         locked=cls.__dataflow_parallel__)
+            code = compile(source, '<dataflow %s>' % cls.__qualname__, 'exec')
+            if cache_path is not None:
+                _store_plan(cache_path, {'topo': topo,
+                                         'descendants': [a._descendants_mask for a in descriptors],
+                                         'ancestors': [a._ancestors_mask for a in descriptors],
+                                         'source': source, 'code': code})
+        namespace = {'_calc_%d' % attr._idx: attr._calc_unbound for attr in descriptors
+                     if attr._calc_unbound is not None}
+        namespace['_same_value'] = _same_value
+        exec(code, namespace)
+        recompute = namespace['_dataflow_recompute']
+        if inline_globals is not None:
+            recompute = types.FunctionType(recompute.__code__, inline_globals,
+                                           recompute.__name__, recompute.__defaults__)
+        if cls.__dataflow_parallel__:
+            # Group the attributes by the length of the longest dependency chain above them.
+            levels = []
+            depth = []
+            for attr in descriptors:
+                depth.append(max([depth[idx] + 1 for idx in attr._dep_idxs], default=0))
+                if depth[-1] == len(levels):
+                    levels.append([])
+                levels[depth[-1]].append(attr)
+                if not isinstance(attr, _ParallelAttr):
+                    attr._mix_in(_ParallelAttr, 'Parallel')
+            cls.__dataflow_lock__ = threading.RLock()
+            # No more than the widest level is ever recalculated at once. The pool does not
+            # depend on the number of CPUs, since update functions worth running in parallel
+            # are the ones that wait or release the GIL.
+            cls.__dataflow_executor__ = ThreadPoolExecutor(
+                max_workers=max([len(level) for level in levels], default=1),
+                thread_name_prefix='dataflow-' + cls.__name__)
+            recompute = _make_parallel_recompute(cls.__dataflow_executor__,
+                                                 [tuple(level) for level in levels], recompute)
+        else:
+            # Attributes and the pool inherited from a parallel base are not needed.
+            for attr in descriptors:
+                attr._mix_out(_ParallelAttr)
+            cls.__dataflow_lock__ = None
+            cls.__dataflow_executor__ = None
+        for attr in attrs.values():
+            attr._recompute = recompute
+        cls.__dataflow_attrs__ = types.MappingProxyType(attrs)
+        cls.__dataflow_topo__ = tuple(topo)
+        cls.__descriptors__ = descriptors
+        cls.__dataflow_defaults__ = tuple(attr._default for attr in descriptors)
+        # Attributes without an initial value start out invalid.
+        cls.__dataflow_dirty__ = sum(attr._bit for attr in descriptors
+                                     if attr._default is AttrNullState)
+        cls.__descendants_mask__ = tuple(attr._descendants_mask for attr in descriptors)
+        cls.__dataflow_source__ = source
+
+def inline_into_dag(func):
+    """
+    Marks an update function to be inlined into the generated recalculation function of the
+    DataflowBase subclasses using it, which saves a method call per update. Worthwhile for
+    small update functions, for instance:
+
+        @inline_into_dag
+        def update_a2(self):
+            self.a2 = self.a1 + 2
+
+    Only simple functions are inlined: a single self argument, no return, yield, nested
+    function or class, lambda, global, nonlocal, import or private name (like self.__scale).
+    Other functions, and those of verbose attributes or parallel classes, are called as usual.
+    """
+    func.__dataflow_inline__ = True
+    return func
 
 class IndependentAttr(DependentAttr):
     """
@@ -122,14 +826,16 @@ class IndependentAttr(DependentAttr):
 
     For example:
 
-        class DataflowSuccess():
+        class DataflowSuccess(DataflowBase):
             a1 = DependentAttr(1, [], None, 'a1')
 
     is identical to:
 
-        class DataflowSuccess():
+        class DataflowSuccess(DataflowBase):
             a1 = IndependentAttr(1, None, 'a1')
     """
+    __slots__ = ()
+
     def __init__(self, init_value, name, verbose=False):
         return super(IndependentAttr, self).__init__(init_value=init_value, 
                                         dependencies=[], calc_func=None, 
@@ -143,14 +849,16 @@ class DeterminantAttr(DependentAttr):
 
     For example:
 
-        class DataflowSuccess():
+        class DataflowSuccess(DataflowBase):
             a2 = DependentAttr(None, ['a1'], 'update_a2', 'a2')
 
     is identical to:
 
-        class DataflowSuccess():
+        class DataflowSuccess(DataflowBase):
             a2 = DependentAttr(['a1'], 'update_a2', 'a2')
     """
+    __slots__ = ()
+
     def __init__(self, dependencies, calc_func, name, verbose=False):
         return super(DeterminantAttr, self).__init__(init_value=AttrNullState, 
                                         dependencies=dependencies, calc_func=calc_func, 
@@ -208,7 +916,7 @@ if __name__ == '__main__':
             else: print('Failure.')
 
     # Now correct the dependency problems in the class by creating a new class.
-    class DataflowSuccess(DataflowFail):
+    class DataflowSuccess(DataflowFail, DataflowBase):
         # This class corrects the dependency problems in the DataflowFail class by using the following descriptors:
         # The following defines the directed acyclic computation graph for these attributes.
         a1 = IndependentAttr(1, 'a1')
@@ -0,0 +1,500 @@
+import copy
+import math
+import os
+import pickle
+import tempfile
+import time
+import unittest
+
+import dataflowAttributes
+from dataflowAttributes import (AttrNullState, DataflowBase, DeterminantAttr, IndependentAttr,
+                                inline_into_dag)
+
+
+class Chain(DataflowBase):
+    a = IndependentAttr(1, 'a')
+    b = DeterminantAttr(['a'], 'update_b', 'b')
+    c = DeterminantAttr(['b'], 'update_c', 'c')
+
+    def update_b(self):
+        self.b = self.a + 1
+
+    def update_c(self):
+        self.c = self.b * 2
+
+
+class Counted(DataflowBase):
+    a = IndependentAttr(1, 'a')
+    b = DeterminantAttr(['a'], 'update_b', 'b')
+    c = DeterminantAttr(['b'], 'update_c', 'c')
+
+    def __init__(self):
+        self.calls = []
+
+    def update_b(self):
+        self.calls.append('b')
+        self.b = None if self.a is None else abs(self.a)
+
+    def update_c(self):
+        self.calls.append('c')
+        self.c = self.b if self.b in (None, AttrNullState) else self.b * 2
+
+
+class BehaviorTest(unittest.TestCase):
+
+    def test_lazy(self):
+        o = Counted()
+        self.assertEqual(o.calls, [])
+        self.assertEqual(o.b, 1)
+        self.assertEqual(o.calls, ['b'])
+        o.a = 3
+        o.a = 4
+        self.assertEqual(o.c, 8)
+        self.assertEqual(o.calls, ['b', 'b', 'c'])
+
+    def test_separate_values_per_instance(self):
+        x, y = Counted(), Counted()
+        x.a = 5
+        self.assertEqual((x.a, x.c), (5, 10))
+        self.assertEqual((y.a, y.c), (1, 2))
+        y.a = 7
+        self.assertEqual((x.a, x.c), (5, 10))
+        self.assertEqual((y.a, y.c), (7, 14))
+
+    def test_equal_value_does_not_invalidate(self):
+        o = Counted()
+        self.assertEqual(o.c, 2)
+        o.a = 1
+        self.assertEqual(o.__dirty__, 0)
+        self.assertEqual(o.c, 2)
+        self.assertEqual(o.calls, ['b', 'c'])
+        # Equal but of another type is a change.
+        o.a = 1.0
+        self.assertEqual(o.c, 2.0)
+        self.assertEqual(o.calls, ['b', 'c', 'b', 'c'])
+
+    def test_memoized_when_input_settles_back(self):
+        o = Counted()
+        self.assertEqual(o.c, 2)
+        o.a = 2
+        o.a = 1
+        self.assertEqual(o.c, 2)
+        self.assertEqual(o.calls, ['b', 'c', 'b'])
+        # Different input, same value of b.
+        o.a = -1
+        self.assertEqual(o.c, 2)
+        self.assertEqual(o.calls, ['b', 'c', 'b', 'b'])
+
+    def test_none_is_a_value(self):
+        o = Counted()
+        o.a = None
+        self.assertIsNone(o.c)
+        self.assertIsNone(o.c)
+        self.assertEqual(o.calls, ['b', 'c'])
+
+    def test_null_state_is_a_value(self):
+        o = Counted()
+        o.a = AttrNullState
+        self.assertIs(o.a, AttrNullState)
+        o.b = AttrNullState
+        self.assertIs(o.b, AttrNullState)
+        self.assertIs(o.c, AttrNullState)
+        self.assertIs(o.c, AttrNullState)
+        self.assertEqual(o.calls, ['c'])
+
+
+class DefinitionTest(unittest.TestCase):
+
+    def test_unknown_dependency(self):
+        with self.assertRaises(KeyError):
+            class Unknown(DataflowBase):
+                a = IndependentAttr(1, 'a')
+                b = DeterminantAttr(['aa'], 'update_b', 'b')
+
+    def test_cycle(self):
+        with self.assertRaises(ValueError):
+            class Cycle(DataflowBase):
+                a = IndependentAttr(1, 'a')
+                b = DeterminantAttr(['a', 'c'], 'update_b', 'b')
+                c = DeterminantAttr(['b'], 'update_c', 'c')
+
+    def test_self_dependency(self):
+        with self.assertRaises(ValueError):
+            class Loop(DataflowBase):
+                b = DeterminantAttr(['b'], 'update_b', 'b')
+
+    def test_missing_update_function(self):
+        class Missing(DataflowBase):
+            a = IndependentAttr(1, 'a')
+            b = DeterminantAttr(['a'], 'update_b', 'b')
+        with self.assertRaises(ValueError):
+            Missing().b
+
+
+def make_shared(parallel):
+    class Shared(DataflowBase, parallel=parallel):
+        a = IndependentAttr(1, 'a')
+        b = DeterminantAttr(['a'], 'update_bc', 'b')
+        c = DeterminantAttr(['a'], 'update_bc', 'c')
+        d = DeterminantAttr(['b', 'c'], 'update_d', 'd')
+
+        def __init__(self):
+            self.calls = []
+
+        def update_bc(self):
+            self.calls.append('bc')
+            # Long enough for a concurrent call to start.
+            time.sleep(0.01)
+            self.b = self.a + 1
+            self.c = self.a + 2
+
+        def update_d(self):
+            self.d = self.b * self.c
+
+    return Shared
+
+
+class SharedUpdateTest(unittest.TestCase):
+
+    def test_called_once(self):
+        o = make_shared(False)()
+        self.assertEqual(o.d, 6)
+        self.assertEqual(o.calls, ['bc'])
+        o.a = 2
+        self.assertEqual(o.d, 12)
+        self.assertEqual(o.calls, ['bc', 'bc'])
+
+    def test_called_once_in_parallel(self):
+        o = make_shared(True)()
+        self.assertEqual(o.d, 6)
+        self.assertEqual(o.calls, ['bc'])
+        o.a = 2
+        self.assertEqual(o.d, 12)
+        self.assertEqual(o.calls, ['bc', 'bc'])
+
+
+def make_pipeline(decorator):
+    class Pipeline(DataflowBase):
+        a = IndependentAttr(1, 'a')
+        x = IndependentAttr(10, 'x')
+        b = DeterminantAttr(['a'], 'update_b', 'b')
+        c = DeterminantAttr(['b', 'x'], 'update_c', 'c')
+        d = DeterminantAttr(['c'], 'update_d', 'd')
+
+        @decorator
+        def update_b(self):
+            "Docstrings are dropped."
+            root = abs(self.a)
+            try:
+                root = math.sqrt(self.a)
+            except ValueError as error:
+                root = -root
+            self.b = round(root)
+
+        @decorator
+        def update_c(self):
+            total = 0
+            for i in range(self.x):
+                total += i
+            self.c = (total, self.b)
+
+        @decorator
+        def update_d(self):
+            self.d = [self.c, len(self.c)]
+
+    return Pipeline
+
+
+class InlineTest(unittest.TestCase):
+
+    def test_inlined(self):
+        Inlined = make_pipeline(inline_into_dag)
+        self.assertNotIn('_calc_', Inlined.__dataflow_source__.split(':', 1)[1])
+
+    def test_same_as_calling(self):
+        Inlined = make_pipeline(inline_into_dag)
+        Called = make_pipeline(lambda func: func)
+        inlined, called = Inlined(), Called()
+        for a, x in [(1, 10), (4, 10), (-9, 10), (-9, 3), (9, 3), (10, 3), (16, 0)]:
+            for o in (inlined, called):
+                o.a = a
+                o.x = x
+            self.assertEqual((inlined.b, inlined.c, inlined.d), (called.b, called.c, called.d))
+            self.assertEqual(inlined.__dataflow_versions__, called.__dataflow_versions__)
+            self.assertEqual(inlined.__dataflow_sigs__, called.__dataflow_sigs__)
+            self.assertEqual(inlined.__dirty__, called.__dirty__)
+
+    def test_memoization(self):
+        o = make_pipeline(inline_into_dag)()
+        d = o.d
+        # a changes but b (rounded) does not, so c and d are not recalculated.
+        o.a = 1.1
+        self.assertIs(o.d, d)
+        o.a = 4
+        self.assertIsNot(o.d, d)
+
+    def check_called(self, update, value=2):
+        class Fallback(DataflowBase):
+            a = IndependentAttr(1, 'a')
+            b = DeterminantAttr(['a'], 'update_b', 'b')
+            update_b = inline_into_dag(update)
+        self.assertIn('_calc_1(obj)', Fallback.__dataflow_source__)
+        self.assertEqual(Fallback().b, value)
+
+    def test_fallbacks(self):
+        def early_return(self):
+            if self.a > 0:
+                self.b = 2
+                return
+            self.b = 0
+        def lambda_(self):
+            self.b = (lambda: self.a * 2)()
+        def reserved_global(self):
+            self.b = self.a * 2 + len(values) - 2
+        def augmented(self):
+            self.b = self.a
+            self.b += 1
+        for update in (early_return, lambda_, reserved_global, augmented):
+            with self.subTest(update.__name__):
+                self.check_called(update)
+
+    def test_private_name(self):
+        self.assertIn('_calc_1(obj)', Scaled.__dataflow_source__)
+        o = Scaled()
+        self.assertEqual(o.b, 2)
+        o.a = 3
+        self.assertEqual(o.b, 6)
+
+
+values = [1, 2]
+
+
+class Scaled(DataflowBase):
+    a = IndependentAttr(1, 'a')
+    b = DeterminantAttr(['a'], 'update_b', 'b')
+    __scale = 2
+
+    @inline_into_dag
+    def update_b(self):
+        self.b = self.a * self.__scale
+
+
+class Tens(DataflowBase, parallel=True):
+    a = IndependentAttr(1, 'a')
+    tens = DeterminantAttr(['a'], 'update_tens', 'tens')
+    units = DeterminantAttr(['a'], 'update_units', 'units')
+    label = DeterminantAttr(['tens'], 'update_label', 'label')
+
+    def update_tens(self):
+        self.tens = self.a // 10
+
+    def update_units(self):
+        self.units = self.a % 10
+
+    def update_label(self):
+        self.label = '%d tens' % self.tens
+
+
+class ParallelTest(unittest.TestCase):
+
+    def test_memoized_under_lock(self):
+        self.assertIn('with type(obj).__dataflow_lock__:', Tens.__dataflow_source__)
+        o = Tens()
+        label = o.label
+        o.a = 5
+        self.assertEqual((o.units, o.tens), (5, 0))
+        self.assertIs(o.label, label)
+        self.assertEqual(o.__dirty__, 0)
+        o.a = 25
+        self.assertEqual((o.label, o.units), ('2 tens', 5))
+
+
+    def test_sequential_subclass(self):
+        class Sequential(Tens, parallel=False):
+            pass
+        self.assertIsNone(Sequential.__dataflow_lock__)
+        self.assertIsNone(Sequential.__dataflow_executor__)
+        self.assertNotIn('__dataflow_lock__', Sequential.__dataflow_source__)
+        for attr in Sequential.__descriptors__:
+            self.assertNotIn('Parallel', type(attr).__name__)
+        for attr in Tens.__descriptors__:
+            self.assertIn('Parallel', type(attr).__name__)
+        o = Sequential()
+        o.a = 25
+        self.assertEqual((o.label, o.units), ('2 tens', 5))
+
+
+class Rounded(DataflowBase):
+    a = IndependentAttr(1, 'a')
+    b = DeterminantAttr(['a'], 'update_b', 'b')
+    c = DeterminantAttr(['b'], 'update_c', 'c')
+
+    def update_b(self):
+        self.b = round(self.a)
+
+    def update_c(self):
+        self.c = self.b * 10
+
+
+class MemoizationTest(unittest.TestCase):
+
+    def test_assigned_value_is_recalculated(self):
+        o = Rounded()
+        self.assertEqual(o.c, 10)
+        o.c = 999
+        o.a = 1.2
+        self.assertEqual(o.c, 10)
+
+    def test_assigned_value_is_recalculated_after_batch(self):
+        o = Rounded()
+        self.assertEqual(o.c, 10)
+        with o.batch_update():
+            o.c = 999
+        o.a = 1.2
+        self.assertEqual(o.c, 10)
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(setattr, dataflowAttributes, 'DATAFLOW_CACHE_DIR',
+                        dataflowAttributes.DATAFLOW_CACHE_DIR)
+        self.addCleanup(setattr, dataflowAttributes, '_module_digest',
+                        dataflowAttributes._module_digest)
+        dataflowAttributes.DATAFLOW_CACHE_DIR = self.directory = directory.name
+
+    def define(self):
+        class Cached(Chain):
+            pass
+        self.assertEqual(Cached().c, 4)
+        return sorted(os.listdir(self.directory))
+
+    def test_reused(self):
+        self.assertEqual(len(self.define()), 1)
+        self.assertEqual(len(self.define()), 1)
+
+    def test_keyed_by_module(self):
+        self.define()
+        dataflowAttributes._module_digest = 'changed'
+        self.assertEqual(len(self.define()), 2)
+
+    def test_disabled_without_module_source(self):
+        dataflowAttributes._module_digest = ''
+        self.assertEqual(self.define(), [])
+
+
+class InheritanceTest(unittest.TestCase):
+
+    def test_inherited_attributes(self):
+        class Sub(Chain):
+            def update_c(self):
+                self.c = self.b * 3
+        o = Sub()
+        self.assertEqual(o.c, 6)
+        o.a = 2
+        self.assertEqual(o.c, 9)
+        self.assertEqual(Chain().c, 4)
+
+    def test_plain_override_leaves_the_graph(self):
+        class Sub(Chain):
+            c = 'plain override'
+        self.assertEqual(Sub.__dict__['c'], 'plain override')
+        self.assertNotIn('c', Sub.__dataflow_attrs__)
+        o = Sub()
+        o.a = 2
+        self.assertEqual(o.b, 3)
+        self.assertEqual(o.c, 'plain override')
+
+    def test_override_of_a_dependency(self):
+        with self.assertRaises(KeyError):
+            class Sub(Chain):
+                b = 'plain override'
+
+
+class CopyTest(unittest.TestCase):
+
+    def check_independent(self, x, y):
+        self.assertEqual(y.c, 4)
+        y.a = 5
+        self.assertEqual(y.c, 12)
+        self.assertEqual(x.a, 1)
+        self.assertEqual(x.c, 4)
+        x.a = 2
+        self.assertEqual(x.c, 6)
+        self.assertEqual(y.c, 12)
+
+    def test_copy(self):
+        x = Chain()
+        x.c
+        self.check_independent(x, copy.copy(x))
+
+    def test_deepcopy(self):
+        x = Chain()
+        x.c
+        self.check_independent(x, copy.deepcopy(x))
+
+    def test_pickle(self):
+        x = Chain()
+        x.c
+        self.check_independent(x, pickle.loads(pickle.dumps(x)))
+
+    def test_copy_within_batch(self):
+        x = Chain()
+        with x.batch_update():
+            y = copy.copy(x)
+            y.a = 5
+            self.assertEqual(y.c, 12)
+        self.assertEqual(x.c, 4)
+
+
+class BatchUpdateTest(unittest.TestCase):
+
+    def test_deferred_until_exit(self):
+        o = Chain()
+        self.assertEqual(o.c, 4)
+        with o.batch_update():
+            o.a = 5
+            self.assertEqual(o.a, 1)
+            self.assertEqual(o.c, 4)
+        self.assertEqual(o.a, 5)
+        self.assertEqual(o.c, 12)
+
+    def test_nested_batches_join_the_outer_one(self):
+        o = Chain()
+        with o.batch_update():
+            with o.batch_update():
+                o.a = 5
+            self.assertEqual(o.a, 1)
+        self.assertEqual(o.c, 12)
+
+    def test_applied_on_exception(self):
+        o = Chain()
+        with self.assertRaises(KeyError):
+            with o.batch_update():
+                o.a = 5
+                raise KeyError
+        self.assertEqual(o.c, 12)
+
+    def test_recalculation_within_batch(self):
+        o = Chain()
+        o.a = 3
+        with o.batch_update():
+            self.assertEqual(o.c, 8)
+            o.a = 4
+        self.assertEqual(o.c, 10)
+
+    def test_invalid_attribute_assigned_in_order(self):
+        o = Chain()
+        o.b
+        o.a = 5
+        with o.batch_update():
+            o.a = 9
+            o.b = 42
+        self.assertEqual(o.b, 42)
+        self.assertEqual(o.c, 84)
+
+
+if __name__ == '__main__':
+    unittest.main()